@@ -1,3 +1,5 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 __version__ = '0.1.3'
+
+default_app_config = 'view_perms.apps.ViewPermsConfig'
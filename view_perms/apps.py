@@ -1,7 +1,25 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class ViewPermsConfig(AppConfig):
     name = 'view_perms'
+
+    def ready(self):
+        from django.contrib.auth.models import Permission
+
+        from .middleware.check_view_perm import schedule_clear_perm_cache
+
+        # keep the middleware's permission cache in sync with the database
+        post_save.connect(
+            schedule_clear_perm_cache,
+            sender=Permission,
+            dispatch_uid='view_perms_clear_cache',
+        )
+        post_delete.connect(
+            schedule_clear_perm_cache,
+            sender=Permission,
+            dispatch_uid='view_perms_clear_cache',
+        )
@@ -10,9 +10,12 @@ from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
 from django.core.management import CommandError
 from django.core.management.base import AppCommand
+from django.db import transaction
 from django.urls import RegexURLPattern, RegexURLResolver
 from django.utils import timezone, translation
-from django.utils.translation import ugettext_lazy
+from django.utils.translation import ugettext
+
+from ...middleware.check_view_perm import clear_perm_cache
 
 logger = logging.getLogger(__name__)
 root_urlconf = import_module(settings.ROOT_URLCONF)  # import root_urlconf module
@@ -21,42 +24,46 @@ all_urlpatterns = root_urlconf.urlpatterns  # project's urlpatterns
 
 def get_all_views(urlpatterns):
     """
-    Return the list of all view callbacks in a URL pattern.
+    Return the list of all view callbacks in an iterable of URL patterns.
 
-    This function works recursively on the given url pattern
+    Nested url patterns are walked iteratively, using an explicit stack
     """
-    assert isinstance(urlpatterns, (RegexURLPattern, RegexURLResolver))
-
-    view_funcs = []
-    for pattern in urlpatterns:
+    view_funcs = set()
+    stack = list(urlpatterns)
+    while stack:
+        pattern = stack.pop()
         if isinstance(pattern, RegexURLResolver):
-            view_funcs.extend(get_all_views(pattern.url_patterns))
+            stack.extend(pattern.url_patterns)
         # TODO: what about the new `path()` url patterns?
         elif isinstance(pattern, RegexURLPattern):
             if pattern.callback:  # if it points to a view
-                view_func = pattern.callback
-                view_funcs.append(view_func)
+                view_funcs.add(pattern.callback)
 
     # view_funcs = [item for item in get_resolver(None).reverse_dict.keys() if callable(item)]
-    view_funcs = list(set(view_funcs))
     # TODO: sort the list by callback full name
     # view_funcs.sort()
-    return view_funcs
+    return list(view_funcs)
 
 
 def get_view_name(view_func):
     """
     Return the fully qualified name of the view function or class
-    """
 
-    if hasattr(view_func, 'view_class'):
-        # A class-based view
-        view_path = '.'.join(
-            [view_func.view_class.__module__, view_func.view_class.__name__]
-        )
-    else:
-        # A function-based view
-        view_path = '.'.join([view_func.__module__, view_func.__name__])
+    The name is computed once and memoized on the view function.
+    """
+    try:
+        return view_func.__dict__['_view_perm_name']
+    except (AttributeError, KeyError):
+        pass
+
+    # the class of a class-based view, otherwise the view function itself
+    view = getattr(view_func, 'view_class', None) or view_func
+    view_path = view.__module__ + '.' + view.__name__
+
+    try:
+        view_func._view_perm_name = view_path
+    except AttributeError:
+        pass  # e.g. a builtin or a bound method, can't memoize
     return view_path
 
 
@@ -137,28 +144,37 @@ class Command(AppCommand):
             help='Remove stale permissions which do not have a corresponding view and are no longer necessary',
         )
 
-    def handle_app_config(self, app_config, **options):
+    def handle(self, *app_labels, **options):
         verbosity = options['verbosity']
         language = options['language']
-        delete_perms = options['delete_perms']
-        prune_stale = options['prune_stale']
-        perm_prefix = options['perm_prefix']
 
+        # activate the language once for all the given apps
         if verbosity >= 1:
             self.stdout.write("Trying to set the language to '{}'".format(language))
         translation.activate(language)
         if verbosity >= 1:
             self.stdout.write("Language set to '{}'".format(translation.get_language()))
 
+        return super(Command, self).handle(*app_labels, **options)
+
+    def handle_app_config(self, app_config, **options):
+        verbosity = options['verbosity']
+        delete_perms = options['delete_perms']
+        prune_stale = options['prune_stale']
+        perm_prefix = options['perm_prefix']
+        app_perm_prefix = perm_prefix + app_config.name
+
         all_views = get_all_views(all_urlpatterns)
         # app_views = [view for view in all_views if view.__module__.startswith(app_config.name)]
         # app_views.sort(key=lambda x: '{}.{}'.format(x.__module__, x.__name__))
 
-        app_views = []
-        for view_func in all_views:
-            view_name = get_view_name(view_func)
-            if view_name.startswith(app_config.name):
-                app_views.append(view_func)
+        # (view_func, view_name) pairs of the views belonging to the app
+        named_views = [(view_func, get_view_name(view_func)) for view_func in all_views]
+        app_views = [
+            (view_func, view_name)
+            for view_func, view_name in named_views
+            if view_name.startswith(app_config.name + '.')
+        ]
 
         if verbosity >= 0:
             self.stdout.write(
@@ -178,10 +194,11 @@ class Command(AppCommand):
             try:
                 perms = Permission.objects.filter(
                     content_type=content_type,
-                    codename__startswith='{}{}.'.format(perm_prefix, app_config.name),
+                    codename__startswith=app_perm_prefix + '.',
                 )
-                perm_count = len(perms)
-                perms.delete()
+                # the total also counts cascaded user/group permission rows
+                _, deleted_per_model = perms.delete()
+                perm_count = deleted_per_model.get(Permission._meta.label, 0)
 
                 if verbosity >= 0:
                     self.stdout.write("{} permissions deleted".format(perm_count))
@@ -190,35 +207,36 @@ class Command(AppCommand):
                 raise CommandError("{}".format(e))
 
         if prune_stale:
-            perm_count = 0
-
             try:
                 perms = Permission.objects.filter(
                     content_type=content_type,
-                    codename__startswith='{}{}.'.format(perm_prefix, app_config.name),
+                    codename__startswith=app_perm_prefix + '.',
+                )
+                app_view_names = set(
+                    perm_prefix + view_name for _, view_name in app_views
                 )
-                app_view_names = [
-                    '{}{}'.format(perm_prefix, get_view_name(view_func))
-                    for view_func in app_views
-                ]
 
                 if verbosity >= 2:
                     self.stdout.write(
                         "Currently {} view access permissions for app '{}' exist".format(
-                            len(perms), app_config.name
+                            perms.count(), app_config.name
                         )
                     )
 
-                for perm in perms:
-                    if perm.codename not in app_view_names:
-                        if verbosity >= 1:
-                            self.stdout.write(
-                                "View access permission is no longer necessary. '{}'".format(
-                                    perm.codename
-                                )
+                # query parameters are bounded by the number of views, not
+                # by the number of stale permissions
+                stale_perms = perms.exclude(codename__in=app_view_names)
+                if verbosity >= 1:
+                    for codename in stale_perms.values_list('codename', flat=True):
+                        self.stdout.write(
+                            "View access permission is no longer necessary. '{}'".format(
+                                codename
                             )
-                        perm.delete()
-                        perm_count += 1
+                        )
+
+                # the total also counts cascaded user/group permission rows
+                _, deleted_per_model = stale_perms.delete()
+                perm_count = deleted_per_model.get(Permission._meta.label, 0)
 
                 if verbosity >= 0:
                     self.stdout.write("{} permissions deleted".format(perm_count))
@@ -227,15 +245,24 @@ class Command(AppCommand):
                 raise CommandError("{}".format(e))
 
         try:
-            perm_count = 0
+            # fetch all existing permissions of the app at once
+            existing_perms = {
+                perm.codename: perm
+                for perm in Permission.objects.filter(
+                    content_type=content_type,
+                    codename__startswith=app_perm_prefix + '.',
+                )
+            }
+            perms_to_create = []
+            perms_to_update = []
+            ignore_list = frozenset(getattr(settings, 'VIEW_PERMS_IGNORE_LIST', ()))
 
-            for view_func in app_views:
-                view_name = get_view_name(view_func)
-                perm_codename = '{}{}'.format(perm_prefix, view_name)
+            for view_func, view_name in app_views:
+                perm_codename = perm_prefix + view_name
 
                 # TODO: support both an include and exclude list, mutually exclusive.
                 # TODO: support glob patterns in include and exclude lists.
-                if view_name in getattr(settings, 'VIEW_PERMS_IGNORE_LIST', []):
+                if view_name in ignore_list:
                     if verbosity >= 1:
                         self.stdout.write(
                             "View access permission ignored for '{}'".format(view_name)
@@ -255,48 +282,56 @@ class Command(AppCommand):
                 # TODO: If a view is CBV, add permission for each http
                 # method that it supports, if asked by the user.
 
-                view_name_trans = view_name  # translated view name
-                if hasattr(view_func, 'view_class'):
-                    if hasattr(view_func.view_class, '__name_trans__'):
-                        view_name_trans = view_func.view_class.__name_trans__
-                elif hasattr(view_func, '__name_trans__'):
-                    view_name_trans = view_func.__name_trans__
+                # translated view name
+                view_name_trans = getattr(
+                    getattr(view_func, 'view_class', None) or view_func,
+                    '__name_trans__',
+                    view_name,
+                )
 
-                perm_name = ugettext_lazy("Can access view %(view_name)s") % {
+                perm_name = ugettext("Can access view %(view_name)s") % {
                     'view_name': view_name_trans
                 }
 
-                try:
-                    perm = Permission.objects.get(
-                        content_type=content_type, codename=perm_codename
-                    )
-                    if perm:
-                        if verbosity >= 1:
-                            self.stdout.write(
-                                "View access permission already exists for '{}'".format(
-                                    view_name
-                                )
+                perm = existing_perms.get(perm_codename)
+                if perm is not None:
+                    if verbosity >= 1:
+                        self.stdout.write(
+                            "View access permission already exists for '{}'".format(
+                                view_name
                             )
+                        )
 
-                        # Update perm name if it exists
+                    # Update perm name if it has changed
+                    if perm.name != perm_name:
                         perm.name = perm_name
-                        perm.save()
+                        if perm.pk is not None:  # not queued for creation
+                            perms_to_update.append(perm)
                         self.stdout.write(
                             "Updated access permission name for '{}'.".format(view_name)
                         )
-                except Permission.MultipleObjectsReturned:
-                    raise CommandError("This should not happen")
-                except Permission.DoesNotExist:
-                    Permission.objects.create(
+                else:
+                    perm = Permission(
                         content_type=content_type,
                         codename=perm_codename,
                         name=perm_name,
                     )
+                    perms_to_create.append(perm)
+                    # several callbacks may share a view name, e.g. the same
+                    # view mounted twice, only create its permission once
+                    existing_perms[perm_codename] = perm
                     if verbosity >= 1:
                         self.stdout.write(
                             "View access permission created for '{}'".format(view_name)
                         )
-                    perm_count += 1
+
+            Permission.objects.bulk_create(perms_to_create, batch_size=500)
+            with transaction.atomic():
+                for perm in perms_to_update:
+                    perm.save(update_fields=['name'])
+            # bulk_create() doesn't send post_save
+            clear_perm_cache()
+            perm_count = len(perms_to_create)
 
             if verbosity >= 0:
                 self.stdout.write("{} permissions created".format(perm_count))
@@ -3,70 +3,165 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import logging
 
+try:
+    from time import monotonic
+except ImportError:  # Python 2
+    from time import time as monotonic
+
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ImproperlyConfigured, PermissionDenied
-from django.urls import resolve
-from django.urls.exceptions import Resolver404
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
 from django.utils.deprecation import MiddlewareMixin
 
 logger = logging.getLogger(__name__)
 
+_PERM_PREFIX = getattr(settings, 'VIEW_PERMS_PREFIX', 'access_view_')
+# seconds for which the existing view permissions are cached
+_CACHE_TIMEOUT = getattr(settings, 'VIEW_PERMS_CACHE_TIMEOUT', 10)
+
+# content_type_id -> (load time, set of existing view permission codenames)
+_perm_codenames_cache = {}
+
+
+def perm_exists(content_type_id, codename):
+    """
+    Return whether a permission with the given codename exists.
+
+    All view permission codenames of the content type are loaded with a
+    single query and cached in-process for `VIEW_PERMS_CACHE_TIMEOUT`
+    seconds, call `clear_perm_cache` whenever permissions are changed.
+
+    The cached set also decides which views have *no* permission, so
+    permissions created by another process, e.g. by `create_view_perms`,
+    are enforced only once the cached set of this process expires.
+    """
+    now = monotonic()
+    cached = _perm_codenames_cache.get(content_type_id)
+    if cached is None or now - cached[0] >= _CACHE_TIMEOUT:
+        codenames = frozenset(
+            Permission.objects.filter(
+                content_type_id=content_type_id, codename__startswith=_PERM_PREFIX
+            ).values_list('codename', flat=True)
+        )
+        cached = _perm_codenames_cache[content_type_id] = (now, codenames)
+    return codename in cached[1]
+
+
+def clear_perm_cache(**kwargs):
+    """
+    Empty the permission existence cache of this process.
+
+    Can be connected directly to model signals.
+    """
+    _perm_codenames_cache.clear()
+
+
+def schedule_clear_perm_cache(using=None, **kwargs):
+    """
+    Empty the permission existence cache once the current transaction
+    is committed.
+
+    Meant to be connected to model signals, the cache is cleared only
+    once per transaction no matter how many rows are changed.
+    """
+    connection = transaction.get_connection(using)
+    # callbacks registered on the connection, for the current transaction
+    for callback in connection.run_on_commit:
+        if callback[1] is clear_perm_cache:
+            return
+    transaction.on_commit(clear_perm_cache, using=using)
+
+
+@receiver(setting_changed)
+def update_settings(setting, **kwargs):
+    global _PERM_PREFIX, _CACHE_TIMEOUT
+    if setting == 'VIEW_PERMS_PREFIX':
+        _PERM_PREFIX = getattr(settings, 'VIEW_PERMS_PREFIX', 'access_view_')
+        clear_perm_cache()
+    elif setting == 'VIEW_PERMS_CACHE_TIMEOUT':
+        _CACHE_TIMEOUT = getattr(settings, 'VIEW_PERMS_CACHE_TIMEOUT', 10)
+        clear_perm_cache()
+
 
 class ViewPermissionMiddleware(MiddlewareMixin):
     """
-    This middleware class tries to find the view name which is about
-    to be run and check whether the logged in user has been granted the
-    per-view permission to access it.
+    This middleware class takes the view which is about to be run, as
+    resolved by Django's URL dispatcher, and checks whether the logged
+    in user has been granted the per-view permission to access it.
 
     Should be placed after `django.contrib.auth` middleware.
     """
 
-    def process_request(self, request):
-        if not hasattr(request, 'user'):
-            raise ImproperlyConfigured(
-                "'{}' needs to be placed after django auth middleware".format(
-                    self.__class__.__name__
+    def __init__(self, get_response=None):
+        super(ViewPermissionMiddleware, self).__init__(get_response)
+        self._content_type_id = None
+
+    def get_content_type_id(self):
+        """
+        Return the id of the content type view permissions are assigned to.
+
+        It is looked up once and then kept for the lifetime of the process.
+        """
+        if self._content_type_id is None:
+            try:
+                self._content_type_id = ContentType.objects.get_for_model(
+                    get_user_model()
+                ).pk
+            except (
+                ContentType.DoesNotExist,
+                ContentType.MultipleObjectsReturned,
+            ) as e:
+                raise ImproperlyConfigured(
+                    "Failed to find user content type: '{}'".format(e)
                 )
-            )
+        return self._content_type_id
 
+    @staticmethod
+    def get_perm_codename(view, perm_prefix):
+        """
+        Return the view name and its permission codename.
+
+        Both are memoized on the view function, along with the prefix
+        used, so they're only computed once per view.
+        """
         try:
-            content_type = ContentType.objects.get_for_model(get_user_model())
-        except (ContentType.DoesNotExist, ContentType.MultipleObjectsReturned) as e:
-            raise ImproperlyConfigured(
-                "Failed to find user content type: '{}'".format(e)
-            )
+            cached = view.__dict__['_view_perm_codename']
+        except (AttributeError, KeyError):
+            cached = None
+        if cached is not None and cached[0] == perm_prefix:
+            return cached[1:]
 
+        view_name = view.__module__ + '.' + view.__name__
+        perm_codename = perm_prefix + view_name
         try:
-            view = resolve(request.get_full_path())[0]
-        except Resolver404:
-            logger.warning(
-                "path '{}' could not be resolved. not enforcing view permission".format(
-                    request.get_full_path()
+            view._view_perm_codename = (perm_prefix, view_name, perm_codename)
+        except AttributeError:
+            pass  # e.g. a bound method, can't memoize
+        return view_name, perm_codename
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not hasattr(request, 'user'):
+            raise ImproperlyConfigured(
+                "'{}' needs to be placed after django auth middleware".format(
+                    self.__class__.__name__
                 )
             )
-            return
 
+        content_type_id = self.get_content_type_id()
+
+        view = view_func
         if hasattr(view, 'view_func'):
             logger.error('FIXME')  ## FIXME related to CBVs?
             view = view.view_func
 
-        view_name = '{}.{}'.format(view.__module__, view.__name__)
-        perm_prefix = getattr(settings, 'VIEW_PERMS_PREFIX', 'access_view_')
-        perm_codename = '{}{}'.format(perm_prefix, view_name)
+        view_name, perm_codename = self.get_perm_codename(view, _PERM_PREFIX)
 
-        # Permission = apps.get_model('auth', 'Permission')
-        try:
-            perm = Permission.objects.get(
-                content_type=content_type, codename=perm_codename
-            )
-        except Permission.MultipleObjectsReturned:
-            logger.error(
-                "This should not happen: '{}', '{}'".format(content_type, perm_codename)
-            )
-        except Permission.DoesNotExist:
+        if not perm_exists(content_type_id, perm_codename):
             ## TODO: also check if perm has been put in ignore list
             logger.debug(
                 "permission named '{}' does not exist. not enforcing view permission".format(
@@ -75,9 +170,15 @@ class ViewPermissionMiddleware(MiddlewareMixin):
             )
             return
 
-        if not request.user.is_authenticated or not request.user.has_perm(
-            'auth.{}'.format(perm_codename)
-        ):
+        # views without a permission stay public, so anonymous users can
+        # only be rejected once the (cached) existence check has passed
+        if not request.user.is_authenticated:
+            logger.debug(
+                "anonymous user tried to access view '{}'".format(view_name)
+            )
+            raise PermissionDenied()
+
+        if not request.user.has_perm('auth.' + perm_codename):
             logger.debug(
                 "user '{}' tried to access view '{}' without being granted access to".format(
                     request.user, view_name
@@ -1,5 +1,294 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from django.test import TestCase
+try:
+    from unittest import mock
+except ImportError:  # Python 2
+    import mock
 
-# Create your tests here.
+from django.conf.urls import url
+from django.contrib.auth import get_user_model
+from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import AnonymousUser, Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.db import transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils.six import StringIO
+from django.views.generic import View
+
+from .management.commands import create_view_perms
+from .middleware import check_view_perm
+from .middleware.check_view_perm import ViewPermissionMiddleware, clear_perm_cache
+
+
+def hello_view(request):
+    return HttpResponse('hello')
+
+
+class HelloView(View):
+    greeting = 'hi'
+
+    def get(self, request):
+        return HttpResponse(self.greeting)
+
+
+class HasPermOnlyBackend(object):
+    """
+    An auth backend granting access to views through `has_perm` only
+    """
+
+    def authenticate(self, request, **credentials):
+        return None
+
+    def has_perm(self, user_obj, perm, obj=None):
+        return perm == 'auth.access_view_view_perms.tests.hello_view'
+
+
+# the same views mounted more than once, as different callbacks
+urlpatterns = [
+    url(r'^hello/$', hello_view),
+    url(r'^private/hello/$', login_required(hello_view)),
+    url(r'^hi/$', HelloView.as_view()),
+    url(r'^hello-cbv/$', HelloView.as_view(greeting='hello')),
+]
+
+
+class CreateViewPermsTest(TestCase):
+    def setUp(self):
+        self._all_urlpatterns = create_view_perms.all_urlpatterns
+        create_view_perms.all_urlpatterns = urlpatterns
+
+    def tearDown(self):
+        create_view_perms.all_urlpatterns = self._all_urlpatterns
+
+    def call_command(self, *args):
+        out = StringIO()
+        call_command('create_view_perms', 'view_perms', *args, stdout=out)
+        return out.getvalue()
+
+    def test_views_mounted_twice_get_one_permission(self):
+        out = self.call_command()
+
+        self.assertEqual(
+            self.app_perm_codenames(),
+            [
+                'access_view_view_perms.tests.HelloView',
+                'access_view_view_perms.tests.hello_view',
+            ],
+        )
+        self.assertIn("2 permissions created", out)
+        self.assertIn(
+            "View access permission already exists for 'view_perms.tests.hello_view'",
+            out,
+        )
+
+    def app_perm_codenames(self):
+        return sorted(
+            Permission.objects.filter(
+                codename__startswith='access_view_view_perms.'
+            ).values_list('codename', flat=True)
+        )
+
+    def create_stale_perms(self):
+        """
+        Create permissions without views, granted to a user and a group
+        """
+        content_type = ContentType.objects.get_for_model(get_user_model())
+        perms = [
+            Permission.objects.create(
+                content_type=content_type,
+                codename='access_view_view_perms.tests.{}'.format(name),
+                name='Can access view {}'.format(name),
+            )
+            for name in ('gone_view', 'GoneView')
+        ]
+        user = get_user_model().objects.create_user('user', password='x')
+        user.user_permissions.add(*perms)
+        group = Group.objects.create(name='group')
+        group.permissions.add(*perms)
+
+    def test_prune_stale(self):
+        self.call_command()
+        self.create_stale_perms()
+
+        out = self.call_command('--prune-stale')
+
+        # cascaded user and group permission rows are not counted
+        self.assertIn("2 permissions deleted", out)
+        self.assertIn(
+            "View access permission is no longer necessary. "
+            "'access_view_view_perms.tests.gone_view'",
+            out,
+        )
+        self.assertEqual(
+            self.app_perm_codenames(),
+            [
+                'access_view_view_perms.tests.HelloView',
+                'access_view_view_perms.tests.hello_view',
+            ],
+        )
+
+    def test_delete_perms(self):
+        self.call_command()
+        self.create_stale_perms()
+        other_perm = Permission.objects.get(codename='add_user')
+
+        out = self.call_command('--delete-perms')
+
+        # cascaded user and group permission rows are not counted
+        self.assertIn("4 permissions deleted", out)
+        self.assertEqual(self.app_perm_codenames(), [])
+        self.assertTrue(Permission.objects.filter(pk=other_perm.pk).exists())
+
+    def test_rerun_creates_nothing(self):
+        self.call_command()
+        out = self.call_command()
+
+        self.assertIn("0 permissions created", out)
+
+
+class ViewPermissionMiddlewareTest(TestCase):
+    def setUp(self):
+        clear_perm_cache()
+        self.middleware = ViewPermissionMiddleware()
+        self.user = get_user_model().objects.create_user('user', password='x')
+        self._all_urlpatterns = create_view_perms.all_urlpatterns
+        create_view_perms.all_urlpatterns = urlpatterns
+
+    def tearDown(self):
+        create_view_perms.all_urlpatterns = self._all_urlpatterns
+
+    def is_allowed(self, user, view_func=hello_view):
+        request = RequestFactory().get('/hello/')
+        request.user = user
+        try:
+            self.middleware.process_view(request, view_func, (), {})
+        except PermissionDenied:
+            return False
+        return True
+
+    def test_view_without_permission_is_public(self):
+        self.assertTrue(self.is_allowed(AnonymousUser()))
+        self.assertTrue(self.is_allowed(self.user))
+
+    def test_permission_created_by_command_is_enforced(self):
+        self.assertTrue(self.is_allowed(AnonymousUser()))
+
+        call_command('create_view_perms', 'view_perms', stdout=StringIO())
+
+        self.assertFalse(self.is_allowed(AnonymousUser()))
+        self.assertFalse(self.is_allowed(self.user))
+
+        self.user.user_permissions.add(
+            Permission.objects.get(codename='access_view_view_perms.tests.hello_view')
+        )
+        user = get_user_model().objects.get(pk=self.user.pk)  # fresh perm cache
+        self.assertTrue(self.is_allowed(user))
+
+    def test_permission_created_by_another_process_is_enforced_on_expiry(self):
+        with mock.patch.object(check_view_perm, 'monotonic', return_value=100.0):
+            self.assertTrue(self.is_allowed(AnonymousUser()))
+            self.create_hello_view_perm_without_signals()
+            self.assertTrue(self.is_allowed(AnonymousUser()))
+
+        with mock.patch.object(check_view_perm, 'monotonic', return_value=110.0):
+            self.assertFalse(self.is_allowed(AnonymousUser()))
+
+    def create_hello_view_perm_without_signals(self):
+        # bulk_create() sends no signals, like changes made in a
+        # process other than this one
+        Permission.objects.bulk_create(
+            [
+                Permission(
+                    content_type=ContentType.objects.get_for_model(get_user_model()),
+                    codename='access_view_view_perms.tests.hello_view',
+                    name='Can access view hello_view',
+                )
+            ]
+        )
+
+    def create_hello_view_perm(self):
+        call_command('create_view_perms', 'view_perms', stdout=StringIO())
+        return Permission.objects.get(
+            codename='access_view_view_perms.tests.hello_view'
+        )
+
+    def test_superuser_is_allowed(self):
+        self.create_hello_view_perm()
+        superuser = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'x'
+        )
+
+        self.assertTrue(self.is_allowed(superuser))
+        self.assertFalse(self.is_allowed(self.user))
+
+    def test_permission_through_group_is_allowed(self):
+        group = Group.objects.create(name='hello')
+        group.permissions.add(self.create_hello_view_perm())
+        self.user.groups.add(group)
+
+        self.assertTrue(self.is_allowed(self.user))
+
+    def test_inactive_user_is_denied(self):
+        self.user.user_permissions.add(self.create_hello_view_perm())
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertFalse(self.is_allowed(self.user))
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=[
+            'django.contrib.auth.backends.ModelBackend',
+            'view_perms.tests.HasPermOnlyBackend',
+        ]
+    )
+    def test_permission_granted_by_has_perm_only_backend_is_allowed(self):
+        self.create_hello_view_perm()
+
+        self.assertTrue(self.is_allowed(self.user))
+
+
+class PermCacheInvalidationTest(TransactionTestCase):
+    def create_perms(self, count):
+        content_type = ContentType.objects.get_for_model(get_user_model())
+        return Permission.objects.bulk_create(
+            [
+                Permission(
+                    content_type=content_type,
+                    codename='access_view_view_perms.tests.view_{}'.format(i),
+                    name='Can access view view_{}'.format(i),
+                )
+                for i in range(count)
+            ]
+        )
+
+    def test_cleared_once_after_commit(self):
+        self.create_perms(3)
+
+        with mock.patch.object(check_view_perm, 'clear_perm_cache') as clear:
+            with transaction.atomic():
+                Permission.objects.filter(
+                    codename__startswith='access_view_view_perms.'
+                ).delete()
+                self.assertFalse(clear.called)
+            self.assertEqual(clear.call_count, 1)
+
+    def test_not_cleared_on_rollback(self):
+        self.create_perms(1)
+
+        with mock.patch.object(check_view_perm, 'clear_perm_cache') as clear:
+            try:
+                with transaction.atomic():
+                    Permission.objects.all().delete()
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.assertFalse(clear.called)
+
+            # a later change is still picked up
+            Permission.objects.get(
+                codename='access_view_view_perms.tests.view_0'
+            ).delete()
+            self.assertEqual(clear.call_count, 1)